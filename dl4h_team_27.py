@@ -58,6 +58,7 @@ get_ipython().system('pip install torchvision')
 get_ipython().system('pip install x-transformers')
 get_ipython().system('pip install torchtime')
 get_ipython().system('pip install torchmetrics')
+get_ipython().system('pip install safetensors')
 
 
 # #### Import Installed Dependencies
@@ -67,8 +68,20 @@ get_ipython().system('pip install torchmetrics')
 
 
 # Standard library imports
-from multiprocessing import Manager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import argparse
+import gc
+import math
+import os
+import queue
+import threading
+
+# Let the CUDA caching allocator grow and coalesce its segments, as the seed loop keeps creating and discarding models;
+# this has to be set before torch is imported, and a value set in the environment takes precedence
+os.environ.setdefault(
+    'PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:256,garbage_collection_threshold:0.8'
+)
 
 # Third-party library imports for numerical operations
 import numpy as np
@@ -78,23 +91,41 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.multiprocessing
+import torch.utils.checkpoint
 torch.multiprocessing.set_sharing_strategy('file_system')
 
+# Let the remaining float32 matmuls use TF32 tensor cores where available
+torch.set_float32_matmul_precision('high')
+
 # PyTorch utility for data loading
 from torch.utils.data import DataLoader
 
 # PyTorch Lightning is a high-level wrapper for PyTorch that aids in organizing code for training
 import pytorch_lightning as pl
 
+# Asynchronous checkpoint I/O, so that checkpoints are written in the background while training continues
+from pytorch_lightning.plugins import AsyncCheckpointIO, TorchCheckpointIO
+
 # Torchmetrics is a PyTorch library for various machine learning metrics
 import torchmetrics
 
+# Safetensors stores tensors without pickling them, so that the averaged checkpoints are loaded by memory-mapping
+import safetensors.torch
+
 # X-Transformers is a PyTorch-based library for transformer models
 import x_transformers
 
 # Torchtime is a PyTorch-based library for time series analysis. The data we import here is the MIMIC-IV dataset.
 from torchtime.data import PhysioNet2012
 
+# Parse the flags of the script before anything is trained, ignoring the ones passed by the notebook kernel, but
+# reporting them so that a mistyped flag is noticed right away
+parser = argparse.ArgumentParser()
+parser.add_argument('--no-quant', action='store_true', help='Test the final model without int8 quantization, for exact metrics')
+args, unknown_args = parser.parse_known_args()
+if unknown_args:
+    print('Ignoring unknown arguments:', ' '.join(unknown_args))
+
 
 # ### Data
 # For this notebook, the dataset was already implemented in the code block from the above section, as:
@@ -124,29 +155,87 @@ from torchtime.data import PhysioNet2012
 class PhysioNetDataset(torch.utils.data.Dataset):
     """A PyTorch Dataset for the PhysioNet 2012 data."""
 
-    def __init__(self, split_name, n_timesteps=32, use_temp_cache=False, **kwargs):
+    def __init__(self, split_name, n_timesteps=32, **kwargs):
         """Initialize the dataset with given parameters."""
         self.split_name = split_name
         self.n_timesteps = n_timesteps
-        self.temp_cache = Manager().dict() if use_temp_cache else None
+        self.X = None
 
-    def setup(self):
-        """Prepare the data for the dataset."""
-        # Load the data
-        tt_data = PhysioNet2012(self.split_name, train_prop=0.7, val_prop=0.15, time=False, seed=0)
+    def setup(self, tt_data=None, stats=None):
+        """Prepare the data for the dataset, optionally from already loaded data and given feature statistics."""
+        # The data only needs to be prepared once
+        if self.X is not None:
+            return
+
+        # Load the data, unless it was already loaded for another split
+        if tt_data is None:
+            tt_data = PhysioNet2012(self.split_name, train_prop=0.7, val_prop=0.15, time=False, seed=0)
 
         # Split the data into features and labels
-        self.X, self.y = tt_data.X, tt_data.y
-
-        # Calculate the statistics of the features
-        self.means, self.stds, self.maxes, self.mins = [], [], [], []
-        for i in range(self.X.shape[2]):
-            vals = self.X[:, :, i].flatten()
-            vals = vals[~torch.isnan(vals)]
-            self.means.append(vals.mean())
-            self.stds.append(vals.std())
-            self.maxes.append(vals.max())
-            self.mins.append(vals.min())
+        self.X = getattr(tt_data, f'X_{self.split_name}')
+        self.y = getattr(tt_data, f'y_{self.split_name}')
+
+        # Calculate the statistics of the features, unless they are given (e.g. from the training split)
+        if stats is not None:
+            self.means, self.stds, self.maxes, self.mins = stats
+        else:
+            # Reduce over the samples and time steps of every feature at once, ignoring missing values
+            observed = ~torch.isnan(self.X)
+            n_observed = observed.sum(dim=(0, 1))
+            self.means = torch.nanmean(self.X, dim=(0, 1))
+            self.stds = ((self.X - self.means).square().nansum(dim=(0, 1)) / (n_observed - 1)).sqrt()
+            self.maxes = torch.where(observed, self.X, -math.inf).amax(dim=(0, 1))
+            self.mins = torch.where(observed, self.X, math.inf).amin(dim=(0, 1))
+
+        # Count the valid rows of every sample; samples are padded at the end, so the valid rows form a prefix
+        self.valid_lens = (~torch.isnan(self.X[:, :, 0])).sum(dim=1)
+
+        # Precompute every sample once, so that __getitem__ only has to slice the results
+        self.X_ts, self.X_static, self.bin_ends = self.preprocess(self.X, self.valid_lens)
+
+    def preprocess(self, X, valid_lens):
+        """Bin and normalize all the samples in a single vectorized pass."""
+        # Drop the padding that no sample uses
+        X = X[:, :int(valid_lens.max())]
+        n, n_steps = X.shape[:2]
+        d_ts = self.d_time_series_num()
+        samples = torch.arange(n)
+        steps = torch.arange(n_steps, dtype=torch.int32)
+
+        # Mark the valid rows of every sample, and locate its last valid row
+        valid = steps < valid_lens.unsqueeze(1)
+        last = valid_lens - 1
+
+        # Assign every observation time to a bin, clamping the final observation into the last bin
+        # (0 / 0, for a sample only observed at time 0, also maps to the last bin)
+        time = X[:, :, 0] / 60 / 24
+        time_end = time[samples, last].unsqueeze(1)
+        bins = (time / time_end * self.n_timesteps).nan_to_num(self.n_timesteps).long().clamp_(max=self.n_timesteps - 1)
+
+        # Normalize the time-series values and mark which of them were observed
+        vals = X[:, :, 1:37]
+        observed = ~torch.isnan(vals) & valid.unsqueeze(2)
+        norm = (vals - self.means[1:37]) / (self.stds[1:37] + 1e-7)
+
+        # Count the observations per bin, and keep the value of the last observation in each bin
+        bins = bins.unsqueeze(2).expand_as(vals)
+        X_ts = torch.zeros((n, self.n_timesteps, d_ts * 2))
+        X_ts[:, :, d_ts:].scatter_add_(1, bins, observed.to(X_ts.dtype))
+        rows = torch.where(observed, steps.view(1, -1, 1), -1)
+        last_row = torch.full((n, self.n_timesteps, d_ts), -1, dtype=torch.int32).scatter_reduce_(
+            1, bins, rows, reduce='amax')
+        X_ts[:, :, :d_ts] = torch.where(last_row >= 0, norm.gather(1, last_row.clamp(min=0).long()), 0.)
+
+        # Process the static data, which is recorded on the first row
+        X_static = ((X[:, 0, 37:45] - self.means[37:45]) / (self.stds[37:45] + 1e-7)).nan_to_num(0.)
+        bin_ends = torch.arange(1, self.n_timesteps + 1) / self.n_timesteps * time_end
+
+        # Keep the results in shared memory, so that DataLoader workers hand out views instead of copies
+        return X_ts.share_memory_(), X_static.share_memory_(), bin_ends.share_memory_()
+
+    def stats(self):
+        """Return the means, standard deviations, maxima and minima of the features."""
+        return self.means, self.stds, self.maxes, self.mins
 
     def __len__(self):
         """Return the total number of samples in the dataset."""
@@ -154,40 +243,8 @@ class PhysioNetDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, i):
         """Get a sample from the dataset."""
-        # If the sample is in the cache, return it
-        if self.temp_cache is not None and i in self.temp_cache:
-            return self.temp_cache[i]
-
-        # Prepare the input features
-        ins = self.X[i, ~torch.isnan(self.X[i, :, 0]), :]
-        time = ins[:, 0] / 60 / 24
-        x_static = torch.zeros(self.d_static_num())
-        x_ts = torch.zeros((self.n_timesteps, self.d_time_series_num() * 2))
-
-        # Process the time-series data
-        for i_t, t in enumerate(time):
-            bin = self.n_timesteps - 1 if t == time[-1] else int(t / time[-1] * self.n_timesteps)
-            for i_ts in range(1, 37):
-                x_i = ins[i_t, i_ts]
-                if not torch.isnan(x_i).item():
-                    x_ts[bin, i_ts - 1] = (x_i - self.means[i_ts]) / (self.stds[i_ts] + 1e-7)
-                    x_ts[bin, i_ts - 1 + self.d_time_series_num()] += 1
-
-        # Process the static data
-        bin_ends = torch.arange(1, self.n_timesteps + 1) / self.n_timesteps * time[-1]
-        for i_tab in range(37, 45):
-            x_i = ins[0, i_tab]
-            x_i = (x_i - self.means[i_tab]) / (self.stds[i_tab] + 1e-7)
-            x_static[i_tab - 37] = x_i.nan_to_num(0.)
-
-        # Prepare the final input and output data
-        x = (x_ts, x_static, bin_ends)
+        x = (self.X_ts[i], self.X_static[i], self.bin_ends[i])
         y = self.y[i, 0]
-
-        # Cache the data if needed
-        if self.temp_cache is not None:
-            self.temp_cache[i] = (x, y)
-
         return x, y
 
     def d_static_num(self):
@@ -208,15 +265,80 @@ class PhysioNetDataset(torch.utils.data.Dataset):
 
 
 # #### Collation Function
-# This is just a helper method that is used to zip data into sequences. It is used in the Dataloader that is eventually used for training.
+# This is just a helper method that is used to stack the samples of a batch into tensors. Every sample is binned into the same number of time steps, so no padding is needed. It is used in the Dataloader that is eventually used for training.
 
 # In[60]:
 
 
-# Function to collate data into sequences
+# Function to collate samples into batched tensors
 def collate_into_seqs(batch):
     xs, ys = zip(*batch)
-    return zip(*xs), ys
+    xs_ts, xs_static, times = zip(*xs)
+    return (torch.stack(xs_ts), torch.stack(xs_static), torch.stack(times)), torch.stack(ys)
+
+
+# #### Prefetching Loader
+# The batches built by the workers of a data loader still have to be received and rebuilt from shared memory by the process that trains. This wrapper does that in a background thread, filling a bounded queue of batches, so that the next batches are ready while the current training step runs.
+
+# In[ ]:
+
+
+# Wrapper that fetches the batches of a data loader in a background thread
+class PrefetchLoader:
+    """A wrapper around a data loader that fetches its batches in a background thread."""
+
+    def __init__(self, loader, size=4):
+        """Wrap the given data loader, keeping up to size batches ready."""
+        self.loader = loader
+        self.size = size
+
+    def __len__(self):
+        """Return the number of batches of the wrapped data loader."""
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        """Forward the attributes of the wrapped data loader, e.g. its dataset and sampler."""
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        """Iterate over the batches, fetching them in a background thread."""
+        batches = queue.Queue(maxsize=self.size)
+        stop = threading.Event()
+
+        def put(item):
+            # Give up on putting the item if the consumer stopped iterating before the end of the epoch
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(('batch', batch)):
+                        return
+                put(('done', None))
+            except Exception as e:
+                put(('error', e))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                kind, item = batches.get()
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
 
 
 # #### Data Module
@@ -227,46 +349,68 @@ def collate_into_seqs(batch):
 
 # PyTorch Lightning DataModule for PhysioNet data
 class PhysioNetDataModule(pl.LightningDataModule):
-    def __init__(self, use_temp_cache=False, batch_size=8, num_workers=1, prefetch_factor=2, verbose=0, **kwargs):
+    def __init__(self, batch_size=8, num_workers=None, prefetch_factor=2, verbose=0, **kwargs):
         """Initialize the data module with given parameters."""
-        self.use_temp_cache = use_temp_cache
+        # Default to half of the available cores for data loading
+        if num_workers is None:
+            num_workers = max(1, (os.cpu_count() or 1) // 2)
+
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.prefetch_factor = prefetch_factor
 
         # Create datasets for training, validation, and testing
-        self.ds_train = PhysioNetDataset('train', use_temp_cache=use_temp_cache)
-        self.ds_val = PhysioNetDataset('val', use_temp_cache=use_temp_cache)
-        self.ds_test = PhysioNetDataset('test', use_temp_cache=use_temp_cache)
+        self.ds_train = PhysioNetDataset('train')
+        self.ds_val = PhysioNetDataset('val')
+        self.ds_test = PhysioNetDataset('test')
+        self.tt_data = None
 
         self.prepare_data_per_node = False
         self.allow_zero_length_dataloader_with_multiple_devices: bool = False
 
-        # Arguments for the data loader
+        # Arguments for the data loader; workers are kept alive across epochs, and batches are pinned
+        # so that host-to-device copies can overlap with compute
         self.dl_args = {
             'batch_size': self.batch_size,
-            'prefetch_factor': self.prefetch_factor,
             'collate_fn': collate_into_seqs,
-            'num_workers': num_workers
+            'num_workers': num_workers,
+            'pin_memory': torch.cuda.is_available(),
+            'persistent_workers': num_workers > 0
         }
+        if num_workers > 0:
+            self.dl_args['prefetch_factor'] = self.prefetch_factor
+
+    def set_batch_size(self, batch_size):
+        """Set the batch size of the data loaders that are created from now on."""
+        self.batch_size = batch_size
+        self.dl_args['batch_size'] = batch_size
+
+    def load_data(self):
+        """Load the PhysioNet 2012 data once, for all the splits."""
+        if self.tt_data is None:
+            self.tt_data = PhysioNet2012('train', train_prop=0.7, val_prop=0.15, time=False, seed=0)
+        return self.tt_data
 
     def setup(self, stage=None):
         """Prepare the data for the given stage."""
+        # Every split is normalized with the statistics of the training data, so it is always set up first
+        tt_data = self.load_data()
+        self.ds_train.setup(tt_data)
+        stats = self.ds_train.stats()
+
         if stage is None:
             # If no stage is specified, setup data for all stages
-            self.ds_train.setup()
-            self.ds_val.setup()
-            self.ds_test.setup()
+            self.ds_val.setup(tt_data, stats)
+            self.ds_test.setup(tt_data, stats)
         elif stage == 'fit':
-            # If the stage is 'fit', setup data for training and validation
-            self.ds_train.setup()
-            self.ds_val.setup()
+            # If the stage is 'fit', setup data for validation as well
+            self.ds_val.setup(tt_data, stats)
         elif stage == 'validate':
             # If the stage is 'validate', setup data for validation
-            self.ds_val.setup()
+            self.ds_val.setup(tt_data, stats)
         elif stage == 'test':
             # If the stage is 'test', setup data for testing
-            self.ds_test.setup()
+            self.ds_test.setup(tt_data, stats)
 
     def prepare_data(self):
         """Prepare the data. This method is intentionally left empty."""
@@ -277,8 +421,14 @@ class PhysioNetDataModule(pl.LightningDataModule):
         pass
 
     def train_dataloader(self):
-        """Return a data loader for the training data."""
-        return DataLoader(self.ds_train, shuffle=True, **self.dl_args)
+        """Return a data loader for the training data, whose batches are fetched in a background thread on a single device."""
+        loader = DataLoader(self.ds_train, shuffle=True, **self.dl_args)
+        # Lightning only injects its distributed sampler into actual data loaders, so the loader is left unwrapped when
+        # training on several devices; the trainer is only set once Lightning attaches one
+        trainer = getattr(self, 'trainer', None)
+        if trainer is not None and trainer.world_size > 1:
+            return loader
+        return PrefetchLoader(loader, size=4)
 
     def val_dataloader(self):
         """Return a data loader for the validation data."""
@@ -313,7 +463,7 @@ class PhysioNetDataModule(pl.LightningDataModule):
 # There is no pre-trained model; the model is defined from scratch (down to the multi-layer perceptron) within this code. At a high-level, the following is the model definition:
 # 
 # 1. **Special Embeddings**: This is an embedding layer for special timesteps, such as masked, static, [CLS], etc. It's defined as `nn.Embedding(8, d_embedding)`.
-# 2. **Embedding Layers**: These are the embedding layers for each time series. They are defined using a list comprehension to create a `nn.ModuleList` of `simple_mlp` layers.
+# 2. **Embedding Layers**: These are the embedding layers for each time series. They are defined as a single `simple_mlp` built from `GroupedLinear` layers, so that the separate MLP of every time series is evaluated in one batched matmul.
 # 3. **Observation Embedding**: This is an embedding layer for observations, defined as `nn.Embedding(16, 1)`.
 # 4. **Event Transformers**: These are transformer layers specifically for events. They are defined using a list comprehension to create a `nn.ModuleList` of `x_transformers.Encoder` layers.
 # 5. **Full Event Embedding**: This is an embedding layer for the full event, defined as `nn.Embedding(d_time_series_num + 1, et_dim)`.
@@ -352,18 +502,46 @@ class BatchNormLastDim(nn.Module):
                 # If the input is a 2D tensor, apply BatchNorm directly
                 return self.batch_norm(x)
             case 3:
-                # If the input is a 3D tensor, transpose the last two dimensions and apply BatchNorm, and then transpose back
-                return self.batch_norm(x.transpose(1, 2)).transpose(1, 2)
+                # If the input is a 3D tensor, flatten the leading dimensions, apply BatchNorm, and then restore the shape
+                return self.batch_norm(x.reshape(-1, x.shape[-1])).view_as(x)
             case _:
                 # If the input is not a 2D or 3D tensor, raise an error
                 raise NotImplementedError("BatchNormLastDim not implemented for ndim > 3 or < 2 yet")
 
 
+class GroupedLinear(nn.Module):
+    """A PyTorch Module applying an independent linear layer to each group along the second-to-last dimension."""
+
+    def __init__(self, n_groups, d_in, d_out):
+        """Initialize the module with given parameters."""
+        super().__init__()
+        # Initialize every group the same way nn.Linear would
+        bound = 1 / math.sqrt(d_in)
+        self.weight = nn.Parameter(torch.empty(n_groups, d_in, d_out).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty(n_groups, d_out).uniform_(-bound, bound))
+
+    def forward(self, x):
+        """Apply the linear layers to a tensor of shape [..., n_groups, d_in] with a single batched matmul."""
+        return torch.einsum('...gi,gio->...go', x, self.weight) + self.bias
+
+
+class GroupedBatchNormLastDim(BatchNormLastDim):
+    """A PyTorch Module for applying Batch Normalization to the last dimension of each group of a tensor."""
+
+    def __init__(self, n_groups, d, **kwargs):
+        """Initialize the module with given parameters."""
+        super().__init__(n_groups * d, **kwargs)
+
+    def forward(self, x):
+        """Apply the BatchNorm layer to the input tensor of shape [..., n_groups, d]."""
+        return super().forward(x.reshape(-1, x.shape[-2] * x.shape[-1])).view_as(x)
+
+
 # In[63]:
 
 
 def simple_mlp(d_in, d_out, n_hidden, d_hidden, final_activation=False, input_batch_norm=False,
-               hidden_batch_norm=False, dropout=0., activation=nn.ReLU):
+               hidden_batch_norm=False, dropout=0., activation=nn.ReLU, linear=nn.Linear, batch_norm=BatchNormLastDim):
     """A simple Multi-Layer Perceptron (MLP) implementation in PyTorch."""
 
     # Initialize the list of layers
@@ -372,22 +550,22 @@ def simple_mlp(d_in, d_out, n_hidden, d_hidden, final_activation=False, input_ba
     # If there are no hidden layers, create a single linear layer
     if n_hidden == 0:
         if input_batch_norm:
-            layers.append(BatchNormLastDim(d_in))
-        layers.append(nn.Linear(d_in, d_out))
+            layers.append(batch_norm(d_in))
+        layers.append(linear(d_in, d_out))
     else:
         # If there are hidden layers, create them with optional batch normalization and dropout
         if input_batch_norm:
-            layers.append(BatchNormLastDim(d_in))
-        layers.extend([nn.Linear(d_in, d_hidden), activation(), nn.Dropout(dropout)])
+            layers.append(batch_norm(d_in))
+        layers.extend([linear(d_in, d_hidden), activation(), nn.Dropout(dropout)])
 
         for _ in range(n_hidden - 1):
             if hidden_batch_norm:
-                layers.append(BatchNormLastDim(d_hidden))
-            layers.extend([nn.Linear(d_hidden, d_hidden), activation(), nn.Dropout(dropout)])
+                layers.append(batch_norm(d_hidden))
+            layers.extend([linear(d_hidden, d_hidden), activation(), nn.Dropout(dropout)])
 
         if hidden_batch_norm:
-            layers.append(BatchNormLastDim(d_hidden))
-        layers.append(nn.Linear(d_hidden, d_out))
+            layers.append(batch_norm(d_hidden))
+        layers.append(linear(d_hidden, d_out))
 
     # If final activation is required, add it to the layers
     if final_activation:
@@ -397,12 +575,85 @@ def simple_mlp(d_in, d_out, n_hidden, d_hidden, final_activation=False, input_ba
     return nn.Sequential(*layers)
 
 
+def fuse_batch_norm(module):
+    """
+    Fold every BatchNormLastDim into the nn.Linear that directly follows it. This is only valid in eval mode,
+    where the batch norm is a fixed affine map given by its running statistics.
+
+    Args:
+        module (nn.Module): The module whose nn.Sequential children are fused in place.
+
+    Returns:
+        list: The replaced layers, which can be put back with unfuse_batch_norm.
+    """
+    # Collect the (batch norm, linear) pairs first, since the modules are replaced below
+    pairs = []
+    for seq in module.modules():
+        if isinstance(seq, nn.Sequential):
+            for i in range(len(seq) - 1):
+                if isinstance(seq[i], BatchNormLastDim) and isinstance(seq[i + 1], nn.Linear) \
+                        and seq[i].batch_norm.track_running_stats:
+                    pairs.append((seq, i, seq[i], seq[i + 1]))
+
+    # Linear(BN(x)) = (W * scale) x + (W shift + b), with scale = gamma / sigma and shift = beta - mu * scale
+    with torch.no_grad():
+        for seq, i, bn, linear in pairs:
+            bn = bn.batch_norm
+            scale = torch.rsqrt(bn.running_var + bn.eps)
+            if bn.affine:
+                scale = scale * bn.weight
+            shift = -bn.running_mean * scale
+            if bn.affine:
+                shift = shift + bn.bias
+            fused = nn.Linear(linear.in_features, linear.out_features,
+                              device=linear.weight.device, dtype=linear.weight.dtype)
+            fused.weight.copy_(linear.weight * scale)
+            fused.bias.copy_(linear.weight @ shift + (linear.bias if linear.bias is not None else 0.))
+            seq[i], seq[i + 1] = nn.Identity(), fused
+
+    return pairs
+
+
+def unfuse_batch_norm(pairs):
+    """Restore the layers replaced by fuse_batch_norm."""
+    for seq, i, bn, linear in pairs:
+        seq[i], seq[i + 1] = bn, linear
+
+
 # #### Defining the Model
 # This is where we define the actual model itself. The components defined above (the `PhysionetDataModule`, `simple_mlp`, etc...) will be applied. This is the main model class that defines the key training functions/methods such as `forward()`. It is a PyTorch Lightning module designed for training and evaluating a machine learning model for time-series data analysis that is being conducted here to eveluate the DuETT approach. 
 
 # In[64]:
 
 
+class DuETTLayers(nn.Module):
+    """A PyTorch Module applying the interleaved event and time transformers of DuETT to the embeddings."""
+
+    def __init__(self, event_transformers, time_transformers, grad_ckpt=False):
+        """Initialize the module with the event and time transformer layers."""
+        super().__init__()
+        self.event_transformers = event_transformers
+        self.time_transformers = time_transformers
+        self.grad_ckpt = grad_ckpt
+
+    def apply_layer(self, layer, embeddings):
+        """Apply a transformer layer, recomputing its activations during the backward pass if gradient checkpointing is enabled."""
+        if self.grad_ckpt and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(layer, embeddings, use_reentrant=False)
+        return layer(embeddings)
+
+    def forward(self, psi, event_embeddings, time_embeddings):
+        """Apply each pair of event and time transformers to the embeddings."""
+        for event_transformer, time_transformer in zip(self.event_transformers, self.time_transformers):
+            et_out_shape = (psi.shape[0], psi.shape[2], psi.shape[1], psi.shape[3])
+            embeddings = psi.transpose(1, 2).flatten(2) + event_embeddings.unsqueeze(0)
+            event_outs = self.apply_layer(event_transformer, embeddings).view(et_out_shape).transpose(1, 2)
+            tt_out_shape = event_outs.shape
+            embeddings = event_outs.flatten(2) + time_embeddings
+            psi = self.apply_layer(time_transformer, embeddings).view(tt_out_shape)
+        return psi
+
+
 class Model(pl.LightningModule):
     """A PyTorch Lightning Module for a transformer-based model."""
 
@@ -415,13 +666,15 @@ class Model(pl.LightningModule):
                  pretrain_d_hidden=64, pretrain_dropout=0.5, pretrain_value=True, 
                  pretrain_presence=True, pretrain_presence_weight=0.2, predict_events=True,
                  transformer_dropout=0., pos_frac=None, freeze_encoder=False, seed=0, 
-                 save_representation=None, masked_transform_timesteps=32, **kwargs):
+                 save_representation=None, masked_transform_timesteps=32, compile_forward=False,
+                 use_grad_ckpt=False, warmup_steps=1000, **kwargs):
         """Initialize the model with given parameters."""
         super().__init__()
 
         # Set up hyperparameters
         self.lr = lr
         self.weight_decay = weight_decay
+        self.warmup_steps = warmup_steps
         self.d_time_series_num = d_time_series_num
         self.d_target = d_target
         self.d_embedding = d_embedding
@@ -431,7 +684,8 @@ class Model(pl.LightningModule):
         self.pretrain_dropout = pretrain_dropout
         self.freeze_encoder = freeze_encoder
         self.set_pos_frac(pos_frac)
-        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.torch_rng = None
         self.aug_noise = aug_noise
         self.aug_mask = aug_mask
         self.fusion_method = fusion_method
@@ -442,6 +696,9 @@ class Model(pl.LightningModule):
         self.pretrain_value = pretrain_value
         self.save_representation = save_representation
         self.validation_step_outputs = []
+        self.fused_batch_norms = []
+        self.representation_writer = None
+        self.representation_writes = []
 
         # Register buffers for multi-GPU training
         self.register_buffer("MASKED_EMBEDDING_KEY", torch.tensor(0))
@@ -450,10 +707,10 @@ class Model(pl.LightningModule):
         # Set up special embeddings for any special timesteps, e.g., masked, static, [CLS], etc.
         self.special_embeddings = nn.Embedding(8, d_embedding)
 
-        # Set up embedding layers
-        self.embedding_layers = nn.ModuleList([
-            simple_mlp(2, d_embedding, n_hidden_mlp_embedding, d_hidden_mlp_embedding, hidden_batch_norm=True)
-            for _ in range(d_time_series_num)])
+        # Set up embedding layers, with one MLP per time series, all of which are evaluated together
+        self.embedding_layers = simple_mlp(2, d_embedding, n_hidden_mlp_embedding, d_hidden_mlp_embedding,
+                                           hidden_batch_norm=True, linear=partial(GroupedLinear, d_time_series_num),
+                                           batch_norm=partial(GroupedBatchNormLastDim, d_time_series_num))
 
         # Set up observation embedding
         self.n_obs_embedding = nn.Embedding(16, 1)
@@ -466,28 +723,33 @@ class Model(pl.LightningModule):
         et_dim = d_embedding * (masked_transform_timesteps + 1)
         tt_dim = d_embedding * (d_time_series_num + 1)
 
+        # The event and time transformers are interleaved one layer at a time, so each of them is a depth 1
+        # encoder sharing the same settings, with attention computed by PyTorch's fused scaled_dot_product_attention
+        def transformer_layer(dim):
+            return x_transformers.Encoder(dim=dim, depth=1, heads=n_transformer_head, pre_norm=norm_first,
+                use_scalenorm=scalenorm, attn_dim_head=d_embedding // n_transformer_head, ff_glu=glu,
+                ff_mult=d_feedforward / dim, attn_dropout=transformer_dropout, ff_dropout=transformer_dropout,
+                attn_flash=True)
+
         # Set up event transformers
-        self.event_transformers = nn.ModuleList([x_transformers.Encoder(dim=et_dim, depth=1,
-                heads=n_transformer_head, pre_norm=norm_first, use_scalenorm=scalenorm,
-                attn_dim_head=d_embedding // n_transformer_head, ff_glu=glu,
-                ff_mult=d_feedforward / et_dim, attn_dropout=transformer_dropout,
-                ff_dropout=transformer_dropout) for _ in range(n_duett_layers)])
+        event_transformers = nn.ModuleList([transformer_layer(et_dim) for _ in range(n_duett_layers)])
 
-        # Set up full event embedding
-        self.full_event_embedding = nn.Embedding(d_time_series_num + 1, et_dim)
+        # Set up full event embedding, as a plain table since every row of it is used on each step
+        self.full_event_embedding = nn.Parameter(torch.randn(d_time_series_num + 1, et_dim))
 
         # Set up time transformers
-        self.time_transformers = nn.ModuleList([x_transformers.Encoder(dim=tt_dim, depth=1,
-                heads=n_transformer_head, pre_norm=norm_first, use_scalenorm=scalenorm,
-                attn_dim_head=d_embedding // n_transformer_head, ff_glu=glu,
-                ff_mult=d_feedforward / tt_dim, attn_dropout=transformer_dropout,
-                ff_dropout=transformer_dropout) for _ in range(n_duett_layers)])
+        time_transformers = nn.ModuleList([transformer_layer(tt_dim) for _ in range(n_duett_layers)])
+
+        # The transformer layers are owned by a standalone module, so that the encoder can be traced on its own
+        self.duett_layers = DuETTLayers(event_transformers, time_transformers, grad_ckpt=use_grad_ckpt)
+        self.jit_encoders = {}
 
         # Set up full time embedding
         self.full_time_embedding =  self.cve(batch_norm=True, d_embedding=tt_dim)
 
-        # Set up full representation embedding
-        self.full_rep_embedding = nn.Embedding(tt_dim, 1)
+        # Set up full representation embedding, initialized as nn.Embedding would be, and stored in the
+        # (1, tt_dim) layout it is appended to the time embeddings in
+        self.full_rep_embedding = nn.Parameter(torch.randn(1, tt_dim))
 
         # Set up representation dimension
         d_representation = d_embedding * (d_time_series_num + 1)  # time_series + static
@@ -532,100 +794,116 @@ class Model(pl.LightningModule):
         self.test_auroc = torchmetrics.AUROC(num_classes=num_classes, task=task)
         self.test_ap = torchmetrics.AveragePrecision(num_classes=num_classes, task=task)
 
+        # Optionally compile the forward pass used for training; evaluation runs through the traced encoder instead.
+        # The batch size is compiled as a dynamic dimension, so that the smaller last batch of an epoch does not
+        # trigger a second specialization
+        if compile_forward:
+            self.compiled_forward = torch.compile(self.forward, mode='max-autotune', dynamic=True)
+        else:
+            self.compiled_forward = self.forward
+
     def set_pos_frac(self, pos_frac):
         """Set the fraction of positive samples in the dataset."""
-        if type(pos_frac) == list:
-            pos_frac = torch.tensor(pos_frac, device=torch.device('cuda'))
         self.pos_frac = pos_frac
         if pos_frac is not None:
-            self.pos_weight = 1 / (2 * pos_frac)
-            self.neg_weight = 1 / (2 * (1 - pos_frac))
+            # Keep the class weights in buffers, so that they are moved along with the model
+            pos_frac = torch.as_tensor(pos_frac, dtype=torch.float32)
+            self.register_buffer('pos_weight', 1 / (2 * pos_frac), persistent=False)
+            self.register_buffer('neg_weight', 1 / (2 * (1 - pos_frac)), persistent=False)
 
     def cve(self, d_embedding=None, batch_norm=False):
         """Create a simple MLP with a single hidden layer and optional batch normalization."""
         if d_embedding is None:
             d_embedding = self.d_embedding
-        d_hidden = int(np.sqrt(d_embedding))
+        d_hidden = math.isqrt(d_embedding)
         if batch_norm:
             return nn.Sequential(nn.Linear(1, d_hidden), nn.Tanh(), BatchNormLastDim(d_hidden), nn.Linear(d_hidden, d_embedding))
         return nn.Sequential(nn.Linear(1, d_hidden), nn.Tanh(), nn.Linear(d_hidden, d_embedding))
 
+    def generator(self):
+        """Return the torch random number generator of the model, created on the device the model is on."""
+        if self.torch_rng is None or self.torch_rng.device != self.device:
+            self.torch_rng = torch.Generator(device=self.device).manual_seed(self.seed)
+        return self.torch_rng
+
+    def jit_compile_encoder(self, psi, event_embeddings, time_embeddings):
+        """Trace the transformer layers for the shape of the given inputs, and optimize the trace for inference."""
+        with torch.no_grad():
+            traced = torch.jit.trace(self.duett_layers, (psi, event_embeddings, time_embeddings), check_trace=False)
+        return torch.jit.optimize_for_inference(traced)
+
     def feats_to_input(self, x, batch_size, limits=None):
         """Prepare the input features for the model."""
-        xs_ts, xs_static, times = x
-        xs_ts = list(xs_ts)
-
-        # Process each time series in the batch
-        for i, f in enumerate(xs_ts):
-            n_vars = f.shape[1] // 2
-            if f.shape[0] > self.max_len:
-                f = f[-self.max_len:]
-                times[i] = times[i][-self.max_len:]
-            # Apply augmentation if needed
-            if self.training and self.aug_noise > 0 and not self.pretrain:
-                f[:, :n_vars] += self.aug_noise * torch.randn_like(f[:, :n_vars]) * f[:, n_vars:]
-            f = torch.cat((f, torch.zeros_like(f[:, :1])), dim=1)
-            if self.training and self.aug_mask > 0 and not self.pretrain:
-                mask = torch.rand(f.shape[0]) < self.aug_mask
-                f[mask, :] = 0.
-                f[mask, -1] = 1.
-            xs_ts[i] = f
-        n_timesteps = [len(ts) for ts in times]
-
-        # Pad the time series to the same length
-        pad_to = np.max(n_timesteps)
-        xs_ts = torch.stack([F.pad(t, (0, 0, 0, pad_to - t.shape[0])) for t in xs_ts]).to(self.device)
-        xs_times = torch.stack([F.pad(t, (0, pad_to - t.shape[0])) for t in times]).to(self.device)
-        xs_static = torch.stack(xs_static).to(self.device)
+        xs_ts, xs_static, xs_times = x
+        n_vars = xs_ts.shape[2] // 2
+
+        # Keep only the most recent time steps of the batch
+        if xs_ts.shape[1] > self.max_len:
+            xs_ts = xs_ts[:, -self.max_len:]
+            xs_times = xs_times[:, -self.max_len:]
+
+        # Copy the batch to the device asynchronously, which overlaps with compute since batches are pinned
+        xs_ts = xs_ts.to(self.device, non_blocking=True)
+        xs_times = xs_times.to(self.device, non_blocking=True)
+        xs_static = xs_static.to(self.device, non_blocking=True)
+
+        # Append the mask column, and apply augmentation if needed
+        xs_ts = torch.cat((xs_ts, torch.zeros_like(xs_ts[:, :, :1])), dim=2)
+        if self.training and self.aug_noise > 0 and not self.pretrain:
+            noise = torch.randn(xs_ts.shape[:2] + (n_vars,), device=xs_ts.device, generator=self.generator())
+            xs_ts[:, :, :n_vars] += self.aug_noise * noise * xs_ts[:, :, n_vars:2 * n_vars]
+        if self.training and self.aug_mask > 0 and not self.pretrain:
+            mask = torch.rand(xs_ts.shape[:2], device=xs_ts.device, generator=self.generator()) < self.aug_mask
+            xs_ts[mask] = 0.
+            xs_ts[mask, -1] = 1.
+        n_timesteps = [xs_ts.shape[1]] * xs_ts.shape[0]
 
         # Apply noise augmentation to the static features if needed
         if self.training and self.aug_noise > 0 and not self.pretrain:
-            xs_static += self.aug_noise * torch.randn_like(xs_static)
+            xs_static = xs_static + self.aug_noise * torch.randn(xs_static.shape, device=xs_static.device,
+                                                                 generator=self.generator())
 
         return xs_static, xs_ts, xs_times, n_timesteps
 
     def pretrain_prep_batch(self, x, batch_size):
         """Prepare a batch for pretraining."""
         xs_static, xs_ts, xs_times, n_timesteps = self.feats_to_input(x, batch_size)
-        n_steps = xs_ts.shape[1]
+        n_samples, n_steps = xs_ts.shape[:2]
         n_vars = (xs_ts.shape[2] - 1) // 2
-        y_ts = []
-        y_ts_n_obs = []
+        samples = torch.arange(n_samples, device=xs_ts.device)
         y_events = []
         y_events_mask = []
-        xs_ts_clipped = xs_ts.clone()
-        for batch_i, n in enumerate(n_timesteps):
-            if n < 2:
-                mask_i = n
-            elif self.pretrain_masked_steps > 1:
-                if self.pretrain_masked_steps > n:
-                    mask_i = np.arange(n)
-                else:
-                    mask_i = self.rng.choice(np.arange(n), size=self.pretrain_masked_steps)
-            else:
-                mask_i = self.rng.choice(np.arange(0, n))
-            y_ts.append(xs_ts[batch_i, mask_i, :n_vars])
-            y_ts_n_obs.append(xs_ts[batch_i, mask_i, n_vars:2 * n_vars])
-
-            xs_ts_clipped[batch_i, mask_i, :] = 0.
-            xs_ts_clipped[batch_i, mask_i, -1] = 1.
 
-            if self.predict_events:
-                event_mask_i = self.rng.choice(np.arange(0, self.d_time_series_num))
-                y_events.append(xs_ts[batch_i, :, event_mask_i])
-                y_events_mask.append(xs_ts[batch_i, :, event_mask_i + n_vars].clip(0, 1))
-                xs_ts_clipped[batch_i, :, event_mask_i] = 0
-                xs_ts_clipped[batch_i, :, event_mask_i + n_vars] = -1
-
-        y_ts = torch.stack(y_ts)
-        y_ts_n_obs = torch.stack(y_ts_n_obs)
+        # Sample the masked time steps of every sample at once, with replacement, or mask all of them if
+        # more steps should be masked than there are
+        if self.pretrain_masked_steps > n_steps:
+            mask_inds = torch.arange(n_steps, device=xs_ts.device).expand(n_samples, -1)
+        else:
+            mask_inds = torch.randint(n_steps, (n_samples, self.pretrain_masked_steps), device=xs_ts.device,
+                                      generator=self.generator())
+        masked = xs_ts.gather(1, mask_inds.unsqueeze(2).expand(-1, -1, xs_ts.shape[2]))
+        if self.pretrain_masked_steps == 1:
+            masked = masked.squeeze(1)
+        y_ts = masked[..., :n_vars]
+        y_ts_n_obs = masked[..., n_vars:2 * n_vars]
         y_ts_masks = y_ts_n_obs.clip(0, 1)
-        if len(y_events) > 0:
-            y_events = torch.stack(y_events)
-            y_events_mask = torch.stack(y_events_mask)
+
+        # Mask the sampled time steps, which builds the clipped copy of the batch in the same pass
+        step_mask = torch.zeros((n_samples, n_steps), dtype=torch.bool, device=xs_ts.device).scatter_(1, mask_inds, True)
+        xs_ts_clipped = xs_ts.masked_fill(step_mask.unsqueeze(2), 0.)
+        xs_ts_clipped[:, :, -1].masked_fill_(step_mask, 1.)
+
+        # Sample one event to mask for every sample, across all of its time steps
+        if self.predict_events:
+            event_mask_inds = torch.randint(self.d_time_series_num, (n_samples,), device=xs_ts.device,
+                                            generator=self.generator())
+            y_events = xs_ts[samples, :, event_mask_inds]
+            y_events_mask = xs_ts[samples, :, event_mask_inds + n_vars].clip(0, 1)
+            n_feats = xs_ts.shape[2]
+            xs_ts_clipped.masked_fill_(F.one_hot(event_mask_inds, n_feats).bool().unsqueeze(1), 0.)
+            xs_ts_clipped.masked_fill_(F.one_hot(event_mask_inds + n_vars, n_feats).bool().unsqueeze(1), -1.)
         if self.pretrain_dropout > 0:
-            keep = self.rng.random((batch_size, n_vars)) > self.pretrain_dropout
-            keep = torch.tensor(keep, device=xs_ts.device)
+            keep = torch.rand((batch_size, n_vars), device=xs_ts.device, generator=self.generator()) > self.pretrain_dropout
             # Only drop out values that are unmasked in y
             if y_ts_masks.ndim > 2:
                 keep = torch.logical_or(1 - y_ts_masks.sum(dim=1).clip(0, 1), keep)
@@ -654,53 +932,52 @@ class Model(pl.LightningModule):
             event_mask_inds = torch.cat((event_mask_inds, event_mask_inds[:, :1, :]), dim=1)
 
         # Convert the number of observations to integers and clip to the range of the embedding
-        n_obs_inds = xs_feats[:, :, n_vars:n_vars*2].to(int).clip(0, self.n_obs_embedding.num_embeddings - 1)
+        n_obs_weight = self.n_obs_embedding.weight.squeeze(-1)
+        n_obs_inds = xs_feats[:, :, n_vars:n_vars*2].long().clamp_(0, n_obs_weight.numel() - 1)
 
-        # Replace the number of observations in the features with their embeddings
-        xs_feats[:, :, n_vars:n_vars*2] = self.n_obs_embedding(n_obs_inds).squeeze(-1)
+        # Replace the number of observations in the features with their embeddings, which are single values
+        xs_feats[:, :, n_vars:n_vars*2] = n_obs_weight[n_obs_inds]
 
-        # Prepare the input for the embedding layers
-        embedding_layer_input = torch.empty(xs_feats.shape[:-1] + (n_vars, 2), dtype=xs_feats.dtype, device=xs_feats.device)
-        embedding_layer_input[:, :, :, 0] = xs_feats[:, :, :n_vars]
-        embedding_layer_input[:, :, :, 1] = xs_feats[:, :, n_vars:n_vars*2]
+        # Pair every value with its number of observations, as a view that the grouped embedding layers consume directly
+        embedding_layer_input = xs_feats[:, :, :n_vars*2].unflatten(2, (2, n_vars)).transpose(2, 3)
 
-        # Initialize the output tensor for the embeddings
-        psi = torch.zeros((xs_feats.shape[0], xs_feats.shape[1]+1, n_vars+1, self.d_embedding), dtype=xs_feats.dtype, device=xs_feats.device)
+        # Allocate the output tensor for the embeddings; every slice of it is written below
+        psi = torch.empty((xs_feats.shape[0], xs_feats.shape[1]+1, n_vars+1, self.d_embedding), dtype=xs_feats.dtype, device=xs_feats.device)
 
         # Apply each embedding layer to its corresponding input features
-        for i, el in enumerate(self.embedding_layers):
-            psi[:, :-1, i, :] = el(embedding_layer_input[:, :, i, :])
+        psi[:, :-1, :-1, :] = self.embedding_layers(embedding_layer_input)
 
         # Apply the tabular encoder to the static features
         psi[:, :-1, -1, :] = self.tab_encoder(xs_static).unsqueeze(1)
 
         # Add the special representation embedding to the last time step
-        psi[:, -1, :, :] = self.special_embeddings(self.REPRESENTATION_EMBEDDING_KEY.to(self.device)).unsqueeze(0).unsqueeze(1)
+        psi[:, -1, :, :] = self.special_embeddings(self.REPRESENTATION_EMBEDDING_KEY).unsqueeze(0).unsqueeze(1)
 
         # Create a mask for the special masked embedding
         mask_inds = torch.cat((xs_feats[:, :, -1] == 1, torch.zeros((xs_feats.shape[0], 1), device=xs_feats.device, dtype=torch.bool)), dim=1)
 
         # Apply the special masked embedding to the masked indices
-        psi[mask_inds, :, :] = self.special_embeddings(self.MASKED_EMBEDDING_KEY.to(self.device))
+        psi[mask_inds, :, :] = self.special_embeddings(self.MASKED_EMBEDDING_KEY)
 
         # If event prediction is enabled, apply the special masked embedding to the event mask indices
         if self.predict_events:
-            psi[event_mask_inds, :] = self.special_embeddings(self.MASKED_EMBEDDING_KEY.to(self.device))
+            psi[event_mask_inds, :] = self.special_embeddings(self.MASKED_EMBEDDING_KEY)
 
         # Create the full time embeddings
         time_embeddings = self.full_time_embedding(xs_times.unsqueeze(2))
         time_embeddings = torch.cat((time_embeddings,
-            self.full_rep_embedding.weight.T.unsqueeze(0).expand(xs_feats.shape[0], -1, -1)),
+            self.full_rep_embedding.unsqueeze(0).expand(xs_feats.shape[0], -1, -1)),
             dim=1)
 
-        # Apply each transformer layer to the embeddings
-        for layer_i, (event_transformer, time_transformer) in enumerate(zip(self.event_transformers, self.time_transformers)):
-            et_out_shape = (psi.shape[0], psi.shape[2], psi.shape[1], psi.shape[3])
-            embeddings = psi.transpose(1, 2).flatten(2) + self.full_event_embedding.weight.unsqueeze(0)
-            event_outs = event_transformer(embeddings).view(et_out_shape).transpose(1, 2)
-            tt_out_shape = event_outs.shape
-            embeddings = event_outs.flatten(2) + time_embeddings
-            psi = time_transformer(embeddings).view(tt_out_shape)
+        # Apply each transformer layer to the embeddings, through a traced copy of the frozen encoder during evaluation
+        event_embeddings = self.full_event_embedding
+        if self.freeze_encoder and not self.training:
+            key = tuple(psi.shape)
+            if key not in self.jit_encoders:
+                self.jit_encoders[key] = self.jit_compile_encoder(psi, event_embeddings, time_embeddings)
+            psi = self.jit_encoders[key](psi, event_embeddings, time_embeddings)
+        else:
+            psi = self.duett_layers(psi, event_embeddings, time_embeddings)
 
         # Flatten the last two dimensions of the transformed embeddings
         transformed = psi.flatten(2)
@@ -709,18 +986,16 @@ class Model(pl.LightningModule):
         if self.fusion_method == 'rep_token':
             z_ts = transformed[:, -1, :]
         elif self.fusion_method == 'masked_embed':
+            masked_ind = F.pad(xs_feats[:, :, -1] > 0, (0, 1), value=False).to(torch.uint8)
             if self.pretrain_masked_steps > 1:
-                masked_ind = F.pad(xs_feats[:, :, -1] > 0, (0, 1), value=False)
-                z_ts = []
-                for i in range(transformed.shape[0]):
-                    z_ts.append(F.pad(transformed[i, masked_ind[i], :], (0, 0, 0, self.pretrain_masked_steps - masked_ind[i].sum()), value=0.))
-                z_ts = torch.stack(z_ts)  # batch size x pretrain_masked_steps x d_embedding
+                # Move the masked steps of every sample to the front, keeping their order, and zero out the rest
+                order = masked_ind.sort(dim=1, descending=True, stable=True).indices[:, :self.pretrain_masked_steps]
+                z_ts = transformed.gather(1, order.unsqueeze(2).expand(-1, -1, transformed.shape[2]))
+                z_ts = z_ts.masked_fill(masked_ind.gather(1, order).unsqueeze(2) == 0, 0.)
+                z_ts = F.pad(z_ts, (0, 0, 0, self.pretrain_masked_steps - z_ts.shape[1]), value=0.)  # batch size x pretrain_masked_steps x d_embedding
             else:
-                masked_ind = xs_feats[:, :, -1:]
-                z_ts = []
-                for i in range(transformed.shape[0]):
-                    z_ts.append(transformed[i, torch.nonzero(masked_ind[i].squeeze() == 1), :])
-                z_ts = torch.cat(z_ts, dim=0).squeeze()
+                # Every sample has a single masked step
+                z_ts = transformed[torch.arange(transformed.shape[0], device=transformed.device), masked_ind.argmax(dim=1)]
         elif self.fusion_method == 'averaging':
             z_ts = torch.mean(transformed[:, :-1, :], dim=1)
 
@@ -731,23 +1006,22 @@ class Model(pl.LightningModule):
         if representation:
             return z
 
-        # If pretraining is enabled, prepare the pretraining outputs
+        # If pretraining is enabled, prepare the pretraining outputs, in full precision for the losses
         if pretrain:
             rep_token_head = torch.tile(transformed[:, 0, :].unsqueeze(1), (1, self.masked_transform_timesteps, 1))
-            y_hat_presence = self.pretrain_presence_proj(z).squeeze() if self.pretrain_presence else None
-            y_hat_value = self.pretrain_value_proj(z).squeeze(1) if self.pretrain_value else None
-            z_events = []
+            y_hat_presence = self.pretrain_presence_proj(z).squeeze().float() if self.pretrain_presence else None
+            y_hat_value = self.pretrain_value_proj(z).squeeze(1).float() if self.pretrain_value else None
             y_hat_events, y_hat_events_presence = None, None
             if self.predict_events:
-                for i in range(event_mask_inds.shape[0]):
-                    z_events.append(psi[i][event_mask_inds[i].nonzero(as_tuple=True)].flatten())
-                z_events = torch.stack(z_events)
-                y_hat_events = self.predict_events_proj(z_events).squeeze()
-                y_hat_events_presence = self.predict_events_presence_proj(z_events).squeeze() if self.pretrain_presence else None
+                # Every sample masks a single event across all of its time steps, so gather that event's embeddings
+                event_inds = event_mask_inds[:, 0, :].to(torch.uint8).argmax(dim=1)
+                z_events = psi.gather(2, event_inds.view(-1, 1, 1, 1).expand(-1, psi.shape[1], 1, psi.shape[3])).flatten(1)
+                y_hat_events = self.predict_events_proj(z_events).squeeze().float()
+                y_hat_events_presence = self.predict_events_presence_proj(z_events).squeeze().float() if self.pretrain_presence else None
             return y_hat_value, y_hat_presence, y_hat_events, y_hat_events_presence
 
-        # If pretraining is not enabled, apply the head to the embeddings to get the final output
-        out = self.head(z).squeeze(1)
+        # If pretraining is not enabled, apply the head to the embeddings to get the final output, in full precision
+        out = self.head(z).squeeze(1).float()
 
         # If the representation is to be saved, return it along with the output
         if self.save_representation:
@@ -757,39 +1031,33 @@ class Model(pl.LightningModule):
 
     def configure_optimizers(self):
         """Configure the optimizer for the model."""
-        optimizers = [torch.optim.AdamW([p for l in self.modules() for p in l.parameters()],
-                                        lr=self.lr, weight_decay=self.weight_decay)]
-        return optimizers
+        # Use the single kernel implementation of AdamW when training on a GPU
+        optimizer = torch.optim.AdamW(list(self.parameters()), lr=self.lr, weight_decay=self.weight_decay,
+                                      fused=self.device.type == 'cuda')
+
+        # Warm the learning rate up, updating it after every step
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, partial(warmup_lr_scale, warmup_steps=self.warmup_steps))
+        return {'optimizer': optimizer, 'lr_scheduler': {'scheduler': scheduler, 'interval': 'step'}}
 
     def training_step(self, batch, batch_idx):
         """Perform a training step."""
         # Unpack the batch
         x, y = batch
-        y = torch.tensor(y, dtype=torch.float64, device=self.device)
+        y = y.to(self.device, torch.float32, non_blocking=True)
         batch_size = y.shape[0]
 
         # If pretraining is enabled, prepare the pretraining outputs
         if self.pretrain:
             x_pretrain, y, mask, y_events, y_events_mask = self.pretrain_prep_batch(x, batch_size)
-            y_hat_value, y_hat_presence, y_hat_events, y_hat_events_presence = self.forward(x_pretrain, pretrain=True)
+            y_hat_value, y_hat_presence, y_hat_events, y_hat_events_presence = self.compiled_forward(x_pretrain, pretrain=True)
 
             # Calculate the pretraining loss
             loss = 0
             if self.pretrain_value:
-                if self.pretrain_masked_steps > 1:
-                    for i in range(self.pretrain_masked_steps):
-                        loss += self.pretrain_loss(y_hat_value[:, i] * mask[:, i], y[:, i] * mask[:, i])
-                    loss /= self.pretrain_masked_steps
-                else:
-                    loss = self.pretrain_loss(y_hat_value * mask, y * mask)
+                # A single mean over all the masked steps equals the average of the per-step means
+                loss = self.pretrain_loss(y_hat_value * mask, y * mask)
             if self.pretrain_presence:
-                if self.pretrain_masked_steps > 1:
-                    presence_loss = 0
-                    for i in range(self.pretrain_masked_steps):
-                        presence_loss += self.pretrain_presence_loss(y_hat_presence[:, i], mask[:, i]) * self.pretrain_presence_weight
-                    presence_loss /= self.pretrain_masked_steps
-                else:
-                    presence_loss = self.pretrain_presence_loss(y_hat_presence, mask) * self.pretrain_presence_weight
+                presence_loss = self.pretrain_presence_loss(y_hat_presence, mask) * self.pretrain_presence_weight
                 loss += presence_loss
             if self.predict_events:
                 if self.pretrain_value:
@@ -798,14 +1066,15 @@ class Model(pl.LightningModule):
                     loss += self.pretrain_presence_loss(y_hat_events_presence, y_events_mask) * self.pretrain_presence_weight
         else:
             # If pretraining is not enabled, calculate the loss normally
-            y_hat = self.forward(self.feats_to_input(x, batch_size))
+            y_hat = self.compiled_forward(self.feats_to_input(x, batch_size))
             if self.pos_frac is not None:
                 weight = torch.where(y > 0, self.pos_weight, self.neg_weight)
                 loss = self.loss_function(y_hat, y, weight)
             else:
                 loss = self.loss_function(y_hat, y)
-            self.train_auroc.update(y_hat, y.to(int))
-            self.train_ap.update(y_hat, y.to(int))
+            y_int = y.long()
+            self.train_auroc.update(y_hat, y_int)
+            self.train_ap.update(y_hat, y_int)
 
         # Log the training loss
         self.log('train_loss', loss, sync_dist=True)
@@ -815,7 +1084,7 @@ class Model(pl.LightningModule):
         """Perform a validation step."""
         # Unpack the batch
         x, y = batch
-        y = torch.tensor(y, dtype=torch.float64, device=self.device)
+        y = y.to(self.device, torch.float32, non_blocking=True)
         batch_size = y.shape[0]
 
         # If pretraining is enabled, prepare the pretraining outputs
@@ -826,21 +1095,11 @@ class Model(pl.LightningModule):
             # Calculate the pretraining loss
             loss = 0
             if self.pretrain_value:
-                if self.pretrain_masked_steps > 1:
-                    for i in range(self.pretrain_masked_steps):
-                        loss += self.pretrain_loss(y_hat_value[:, i] * mask[:, i], y[:, i] * mask[:, i])
-                    loss /= self.pretrain_masked_steps
-                else:
-                    loss = self.pretrain_loss(y_hat_value * mask, y * mask)
+                # A single mean over all the masked steps equals the average of the per-step means
+                loss = self.pretrain_loss(y_hat_value * mask, y * mask)
                 self.log('val_next_loss', loss, on_epoch=True, sync_dist=True, rank_zero_only=True)
             if self.pretrain_presence:
-                if self.pretrain_masked_steps > 1:
-                    presence_loss = 0
-                    for i in range(self.pretrain_masked_steps):
-                        presence_loss += self.pretrain_presence_loss(y_hat_presence[:, i], mask[:, i]) * self.pretrain_presence_weight
-                    presence_loss /= self.pretrain_masked_steps
-                else:
-                    presence_loss = self.pretrain_presence_loss(y_hat_presence, mask) * self.pretrain_presence_weight
+                presence_loss = self.pretrain_presence_loss(y_hat_presence, mask) * self.pretrain_presence_weight
                 self.log('val_presence_loss', presence_loss, on_epoch=True, sync_dist=True, rank_zero_only=True)
                 loss += presence_loss
             if self.predict_events:
@@ -857,8 +1116,9 @@ class Model(pl.LightningModule):
             else:
                 loss = self.loss_function(y_hat, y)
             self.validation_step_outputs.append(loss)
-            self.val_auroc.update(y_hat, y.to(int).to(self.device))
-            self.val_ap.update(y_hat, y.to(int).to(self.device))
+            y_int = y.long()
+            self.val_auroc.update(y_hat, y_int)
+            self.val_ap.update(y_hat, y_int)
 
         # Log the validation metrics
         if not self.pretrain:
@@ -873,6 +1133,13 @@ class Model(pl.LightningModule):
             self.log('train_auroc', self.train_auroc, sync_dist=True, rank_zero_only=True)
             self.log('train_ap', self.train_ap, sync_dist=True, rank_zero_only=True)
 
+    # This method is called at the start of each validation loop
+    def on_validation_start(self):
+        # Fold the batch norms into their following linear layers for the duration of the validation
+        self.fused_batch_norms = fuse_batch_norm(self)
+        # Drop the traced encoders, since their weights are baked in and may have been reloaded since they were traced
+        self.jit_encoders.clear()
+
     # This method is called at the end of each validation epoch
     def on_validation_epoch_end(self):
         # If not in pretraining mode, print the validation metrics and clear the validation outputs
@@ -880,22 +1147,60 @@ class Model(pl.LightningModule):
             print("val_auroc", self.val_auroc.compute(), "val_ap", self.val_ap.compute())
         self.validation_step_outputs.clear()
 
+        # Restore the trainable layers before training resumes or a checkpoint is saved
+        unfuse_batch_norm(self.fused_batch_norms)
+        self.fused_batch_norms = []
+
+    # This method is called at the start of each test loop
+    def on_test_start(self):
+        # Fold the batch norms into their following linear layers for the duration of the test
+        self.fused_batch_norms = fuse_batch_norm(self)
+        self.jit_encoders.clear()
+
+        # Write the representations from a background thread, so that the test loop does not wait on the disk
+        if self.save_representation:
+            print("saving representations...")
+            self.representation_writer = ThreadPoolExecutor(max_workers=1)
+
+    # This method is called at the end of each test epoch
+    def on_test_epoch_end(self):
+        # Restore the original layers
+        unfuse_batch_norm(self.fused_batch_norms)
+        self.fused_batch_norms = []
+
+        # Wait for the pending representation writes, raising any error they hit
+        if self.representation_writer is not None:
+            for write in self.representation_writes:
+                write.result()
+            self.representation_writer.shutdown()
+            self.representation_writer = None
+            self.representation_writes = []
+
+    def write_representations(self, rows, copied):
+        """Append a chunk of representations and labels to the representation file, in numpy's binary format."""
+        if copied is not None:
+            copied.synchronize()
+        with open(self.save_representation, 'ab') as f:
+            np.save(f, rows.numpy())
+
     # This method is called for each test step
     def test_step(self, batch, batch_idx):
         x, y = batch
-        y = torch.tensor(y, dtype=torch.float64, device=self.device)
+        y = y.to(self.device, torch.float32, non_blocking=True)
         batch_size = y.shape[0]
 
         # If save_representation is True, save the representations
         if self.save_representation:
             y_hat, z = self.forward(self.feats_to_input(x, batch_size))
 
-            print("saving representations...")
-            with open(self.save_representation, 'ab') as f:
-                if y.ndim == 1:
-                    np.savetxt(f, np.concatenate([z.cpu(), y.unsqueeze(1).cpu()], axis=1))
-                else:
-                    np.savetxt(f, np.concatenate([z.cpu(), y.cpu()], axis=1))
+            # Copy the rows to the host without blocking, and let the writer wait for the copy to finish
+            rows = torch.cat((z, y.unsqueeze(1) if y.ndim == 1 else y), dim=1).detach().float()
+            rows = rows.to('cpu', non_blocking=True)
+            copied = None
+            if self.device.type == 'cuda':
+                copied = torch.cuda.Event()
+                copied.record()
+            self.representation_writes.append(self.representation_writer.submit(self.write_representations, rows, copied))
         else:
             y_hat = self.forward(self.feats_to_input(x, batch_size))
 
@@ -908,9 +1213,10 @@ class Model(pl.LightningModule):
 
         # Log the test metrics
         self.log('test_loss', loss, on_epoch=True, sync_dist=True, rank_zero_only=True)
-        self.test_auroc.update(y_hat, y.to(int).to(self.device))
+        y_int = y.long()
+        self.test_auroc.update(y_hat, y_int)
         self.log('test_auroc', self.test_auroc, on_epoch=True, sync_dist=True, rank_zero_only=True)
-        self.test_ap.update(y_hat, y.to(int).to(self.device))
+        self.test_ap.update(y_hat, y_int)
         self.log('test_ap', self.test_ap, on_epoch=True, sync_dist=True, rank_zero_only=True)
 
         return loss, self.test_auroc, self.test_ap
@@ -920,26 +1226,25 @@ class Model(pl.LightningModule):
         print('Loading from checkpoint')
         state_dict = checkpoint["state_dict"]
         model_state_dict = self.state_dict()
-        is_changed = False
+        # Compare the keys of the checkpoint and the model once
+        missing = model_state_dict.keys() - state_dict.keys()
+        extra = state_dict.keys() - model_state_dict.keys()
+        common = state_dict.keys() & model_state_dict.keys()
+        is_changed = bool(missing or extra)
 
         # Update the state_dict with missing keys from the model_state_dict
-        for k in model_state_dict:
-            if k not in state_dict:
-                state_dict[k] = model_state_dict[k]
-                is_changed = True
+        state_dict.update({k: model_state_dict[k] for k in missing})
 
         # Check for mismatched shapes in the state_dict and model_state_dict
-        for k in state_dict:
-            if k in model_state_dict:
-                if k.startswith('head') and state_dict[k].shape != model_state_dict[k].shape:
-                    print(f"Skip loading parameter: {k}, "
-                          f"required shape: {model_state_dict[k].shape}, "
-                          f"loaded shape: {state_dict[k].shape}")
-                    state_dict[k] = model_state_dict[k]
-                    is_changed = True
-            else:
-                print(f"Dropping parameter {k}")
+        for k in sorted(common):
+            if k.startswith('head') and state_dict[k].shape != model_state_dict[k].shape:
+                print(f"Skip loading parameter: {k}, "
+                      f"required shape: {model_state_dict[k].shape}, "
+                      f"loaded shape: {state_dict[k].shape}")
+                state_dict[k] = model_state_dict[k]
                 is_changed = True
+        for k in sorted(extra):
+            print(f"Dropping parameter {k}")
 
         # If the state_dict was changed, remove the optimizer states from the checkpoint
         if is_changed:
@@ -971,7 +1276,7 @@ class Model(pl.LightningModule):
 # 5. **weight_decay**: This is a regularization term that discourages large weights in the model to prevent overfitting.
 # 6. **transformer_dropout**: This is the dropout rate for the transformer layers. It can help prevent overfitting by randomly setting a fraction of inputs to zero during training.
 # 7. **max_epochs**: This is the maximum number of passes over the entire dataset. It determines how long the model will be trained. This was tweaked during the training to ensure that we are able to run the code on the limited hardware we have.
-# 8. **gradient_clip_val**: This is the maximum allowed value for the gradients. It prevents the gradients from becoming too large and causing numerical instability.
+# 8. **max_norm**: This is the maximum allowed norm for the gradients. It prevents the gradients from becoming too large and causing numerical instability. The clipping is done by the `AdaptiveClipCallback`, which stops clipping once it is no longer needed.
 # 
 # #### Computational Requirements
 # 1. **batch_size**: This is the number of samples that will be propagated through the network at once. It affects the speed and memory usage of model training.
@@ -979,82 +1284,89 @@ class Model(pl.LightningModule):
 # 3. **seed**: This is the random seed for reproducibility. It ensures that the model's results are consistent across different runs.
 
 # #### Learning-Rate Adjustment
-# This is an adjustment that is applied in the initial phase of the training (also known as the warm-up training phase). The task here is to gradually increase the learning rate over a provided number of steps. This is to prevent massive weight updates from the get-go of the training that can lead to divergence or poor convergence.
+# This is an adjustment that is applied in the initial phase of the training (also known as the warm-up training phase). The task here is to gradually increase the learning rate over a provided number of steps. This is to prevent massive weight updates from the get-go of the training that can lead to divergence or poor convergence. It is applied by a `LambdaLR` scheduler that the model configures along with its optimizer.
 
 # In[65]:
 
 
-class WarmUpCallback(pl.callbacks.Callback):
+def warmup_lr_scale(step, warmup_steps=1000):
     """
-    This class is a PyTorch Lightning callback that implements a linear warmup for optimizer's learning rate.
-    It increases the learning rate linearly for a certain number of steps (batches), and then decreases it
-    according to the inverse square root schedule.
+    This function computes the learning rate scale of a training step for a linear warmup, after which the learning
+    rate decreases according to the inverse square root schedule.
+
+    Args:
+        step (int): The index of the training step (batch).
+        warmup_steps (int): Number of steps for the warmup phase.
+
+    Returns:
+        float: The factor to multiply the base learning rate with.
     """
+    if step < warmup_steps:
+        # During the warmup phase, increase the learning rate linearly.
+        return step / warmup_steps
+    # After the warmup phase, decrease the learning rate using the inverse square root schedule.
+    return (warmup_steps / step) ** 0.5
 
-    def __init__(self, steps=1000, base_lr=None, invsqrt=True, decay=None):
-        """
-        Initializes the callback.
 
-        Args:
-            steps (int): Number of steps for the warmup phase.
-            base_lr (float, optional): Initial learning rate. If None, it will be inferred from the optimizer.
-            invsqrt (bool): If True, decrease the learning rate using the inverse square root schedule after the warmup phase.
-            decay (int, optional): Decay rate for the inverse square root schedule. If None, it will be equal to the number of warmup steps.
-        """
-        print(f'warmup_steps {steps}, base_lr {base_lr}, invsqrt {invsqrt}, decay {decay}')
-        self.warmup_steps = steps
-        self.decay = steps if decay is None else decay
-        self.state = {'steps': 0, 'base_lr': float(base_lr) if base_lr is not None else base_lr}
-        self.invsqrt = invsqrt
+# #### Gradient Clipping
+# The gradients are clipped to a maximum norm to keep the early updates stable. Once the gradient norm has stayed well below that maximum for a whole window of steps, clipping is switched off, since it would only cost an extra pass over the gradients on every step.
+
+# In[ ]:
+
+
+class AdaptiveClipCallback(pl.callbacks.Callback):
+    """
+    This class is a PyTorch Lightning callback that clips the norm of the gradients before each optimizer step, and
+    stops clipping once the norm has stayed below a fraction of the maximum for a whole window of steps.
+    """
 
-    def set_lr(self, optimizer, lr):
+    def __init__(self, max_norm=1.0, threshold=0.9, window=200):
         """
-        Sets the learning rate for all parameter groups in the optimizer.
+        Initializes the callback.
 
         Args:
-            optimizer (Optimizer): The optimizer.
-            lr (float): The learning rate.
+            max_norm (float): The maximum norm of the gradients.
+            threshold (float): The fraction of max_norm that the gradient norm has to stay below for clipping to stop.
+            window (int): Number of consecutive steps over which the gradient norm is checked.
         """
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
-
-    def on_train_batch_start(self, trainer, model, batch, batch_idx):
+        self.max_norm = max_norm
+        self.threshold = threshold
+        self.window = window
+        self.state = {'clipping': True}
+        self.window_steps = 0
+        self.window_max_norm = None
+
+    def on_before_optimizer_step(self, trainer, model, optimizer):
         """
-        This method is called at the beginning of each training batch.
-        It adjusts the learning rate according to the schedule.
+        This method is called before each optimizer step. It clips the gradients, and checks whether clipping is still
+        needed at the end of every window. The gradients are usually unscaled by then, except under 16-bit mixed
+        precision with an optimizer that unscales them itself in its step (e.g. fused AdamW), in which case they are
+        still multiplied by the loss scale, and the maximum norm is scaled accordingly.
 
         Args:
             trainer (Trainer): The PyTorch Lightning trainer.
             model (LightningModule): The model that is being trained.
-            batch: The current batch data.
-            batch_idx (int): The index of the current batch.
+            optimizer (Optimizer): The optimizer that is about to step.
         """
-        optimizers = model.optimizers()
-
-        if self.state['steps'] < self.warmup_steps:
-            # During the warmup phase, increase the learning rate linearly.
-            if isinstance(optimizers, list):
-                if self.state['base_lr'] is None:
-                    self.state['base_lr'] = [o.param_groups[0]['lr'] for o in optimizers]
-                for opt, base in zip(optimizers, self.state['base_lr']):
-                    self.set_lr(opt, self.state['steps'] / self.warmup_steps * base)
-            else:
-                if self.state['base_lr'] is None:
-                    self.state['base_lr'] = optimizers.param_groups[0]['lr']
-                self.set_lr(optimizers, self.state['steps'] / self.warmup_steps * self.state['base_lr'])
-            self.state['steps'] += 1
-        elif self.invsqrt:
-            # After the warmup phase, decrease the learning rate using the inverse square root schedule.
-            if isinstance(optimizers, list):
-                if self.state['base_lr'] is None:
-                    self.state['base_lr'] = [o.param_groups[0]['lr'] for o in optimizers]
-                for opt, base in zip(optimizers, self.state['base_lr']):
-                    self.set_lr(opt, base * (self.decay / (self.state['steps'] - self.warmup_steps + self.decay)) ** 0.5)
-            else:
-                if self.state['base_lr'] is None:
-                    self.state['base_lr'] = optimizers.param_groups[0]['lr']
-                self.set_lr(optimizers, self.state['base_lr'] * (self.decay / (self.state['steps'] - self.warmup_steps + self.decay)) ** 0.5)
-            self.state['steps'] += 1
+        if not self.state['clipping']:
+            return
+
+        # Lightning skips unscaling the gradients for optimizers that do it in their step, so clip them at the scaled norm
+        scale = 1.0
+        scaler = getattr(trainer.precision_plugin, 'scaler', None)
+        if scaler is not None and getattr(optimizer, '_step_supports_amp_scaling', False):
+            scale = scaler.get_scale()
+
+        # Keep the largest norm of the window on the device, so that it is only synchronized once per window
+        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), self.max_norm * scale) / scale
+        self.window_max_norm = norm if self.window_max_norm is None else torch.maximum(self.window_max_norm, norm)
+        self.window_steps += 1
+        if self.window_steps == self.window:
+            if self.window_max_norm.item() < self.threshold * self.max_norm:
+                print('Gradient norm stayed below the clipping threshold, disabling gradient clipping')
+                self.state['clipping'] = False
+            self.window_steps = 0
+            self.window_max_norm = None
 
     def load_state_dict(self, state_dict):
         """
@@ -1075,11 +1387,50 @@ class WarmUpCallback(pl.callbacks.Callback):
         return self.state.copy()
 
 
+# #### Safetensors Checkpoints
+# The weights of the best fine-tuned models are saved in the safetensors format instead of as pickled checkpoints, as they are only read back for averaging. These files are read without unpickling anything, which makes loading the best checkpoints for averaging faster. They are written through the checkpoint I/O of the trainer, so that they are saved in the background like the other checkpoints.
+
+# In[ ]:
+
+
+class SafetensorsCheckpointIO(TorchCheckpointIO):
+    """
+    This class is a PyTorch Lightning checkpoint I/O that saves the weights of the checkpoints whose path has the
+    safetensors extension in the safetensors format, and any other checkpoint with torch.save.
+    """
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None):
+        """
+        Saves a checkpoint.
+
+        Args:
+            checkpoint (dict): The checkpoint, whose 'state_dict' holds the weights of the model.
+            path (str): The path to save the checkpoint to.
+            storage_options: Additional options passed on to torch.save for other checkpoints.
+        """
+        if not str(path).endswith(SafetensorsCheckpoint.FILE_EXTENSION):
+            super().save_checkpoint(checkpoint, path, storage_options)
+            return
+        os.makedirs(os.path.dirname(str(path)) or '.', exist_ok=True)
+        state_dict = {k: v.contiguous() for k, v in checkpoint['state_dict'].items()}
+        safetensors.torch.save_file(state_dict, str(path))
+
+
+class SafetensorsCheckpoint(pl.callbacks.ModelCheckpoint):
+    """
+    This class is a PyTorch Lightning ModelCheckpoint that names its checkpoints with the safetensors extension, so that
+    a trainer using SafetensorsCheckpointIO saves only the weights of the model of every checkpoint, in that format.
+    """
+
+    FILE_EXTENSION = '.safetensors'
+
+
 # #### Methods to Assist With Training Process
 # The following methods are called throughout the training process; the key methods are:
 #     1. **Pre-Training**: This is where the model is initialized for pre-training
 #     2. **Fine-Tuning**: This method is invoked after the initial round of trainings as part of the DuETT task that this project is experimenting with.
-#     3. **Averaging-Models**: Once we have different versions of the fine-tuned model, we average them to get the *best* model (according to this paper).
+#     3. **Averaging-Models**: Once we have different versions of the fine-tuned model, we average them to get the *best* model (according to this paper), reading one checkpoint at a time.
+#     4. **Picking-Accelerator**: This picks the device to train on, along with the fastest precision that the device supports.
 
 # In[66]:
 
@@ -1111,8 +1462,7 @@ def fine_tune_model(ckpt_path, **kwargs):
     Returns:
         Model: The model loaded from the checkpoint.
     """
-    return Model.load_from_checkpoint(
-        ckpt_path,
+    model = Model(
         pretrain=False,
         aug_noise=0.,
         aug_mask=0.5,
@@ -1123,27 +1473,62 @@ def fine_tune_model(ckpt_path, **kwargs):
         **kwargs
     )
 
+    # Memory-map the checkpoint on the CPU, so that its tensors are paged in as they are copied into the model,
+    # and restore it the way Model.load_from_checkpoint would
+    checkpoint = torch.load(ckpt_path, map_location='cpu', mmap=True, weights_only=False)
+    model.on_load_checkpoint(checkpoint)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
+
 
-def average_models(models):
+def streaming_average(paths, model):
     """
-    This function averages the weights of a list of models and loads the resulting weights into the first model.
+    This function averages the weights of the models saved in a list of checkpoints, reading their state dicts one at
+    a time, and loads the resulting weights into the given model.
 
     Args:
-        models (list): A list of models whose weights are to be averaged.
+        paths (list): The paths of the checkpoint or safetensors files whose weights are to be averaged.
+        model (Model): A model with the same architecture as the saved ones, e.g. the model that was trained.
 
     Returns:
-        Model: The first model in the list, but with the weights replaced by their average.
+        Model: The given model, but with the weights replaced by their average.
     """
-    models = list(models)
-    n = len(models)
-    sds = [m.state_dict() for m in models]
-    averaged = {}
+    paths = list(paths)
+    n = len(paths)
+    averaged = None
+
+    # Accumulate the running mean in float32, memory-mapping each checkpoint and releasing it before the next one
+    for path in paths:
+        if path.endswith('.safetensors'):
+            state_dict = safetensors.torch.load_file(path, device='cpu')
+        else:
+            checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+            # Lightning checkpoints keep the weights under 'state_dict', even weights-only ones; bare state dicts are used
+            # as is
+            state_dict = checkpoint.get('state_dict', checkpoint)
+            del checkpoint
+        if averaged is None:
+            averaged = {k: v.float() / n for k, v in state_dict.items()}
+        else:
+            for k, v in state_dict.items():
+                averaged[k].add_(v.float(), alpha=1 / n)
+        del state_dict
+
+    model.load_state_dict(averaged)
+    return model
 
-    for k in sds[0]:
-        averaged[k] = sum(sd[k] for sd in sds) / n
 
-    models[0].load_state_dict(averaged)
-    return models[0]
+def pick_accel():
+    """
+    This function picks the accelerator to train on, and the mixed precision that it supports.
+
+    Returns:
+        tuple: The accelerator and the precision to pass to the Trainer; bf16 on GPUs that support it, fp16 on
+            older GPUs, and full precision on the CPU.
+    """
+    if torch.cuda.is_available():
+        return 'gpu', 'bf16-mixed' if torch.cuda.is_bf16_supported() else '16-mixed'
+    return 'cpu', '32-true'
 
 
 # #### Pre-Train the Model
@@ -1162,8 +1547,14 @@ def average_models(models):
 seed = 2020
 pl.seed_everything(seed)
 
-# Initialize the data module
-dm = PhysioNetDataModule(batch_size=64, num_workers=2, use_temp_cache=True)
+# Pick the accelerator and precision to train with
+accelerator, precision = pick_accel()
+
+# Compile the training forward passes on GPUs, with a PyTorch version whose torch.compile is mature enough
+compile_forward = accelerator == 'gpu' and tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+
+# Initialize the data module, with enough workers and prefetched batches to keep the accelerator fed
+dm = PhysioNetDataModule(batch_size=64, num_workers=max(4, (os.cpu_count() or 1) // 2), prefetch_factor=4)
 dm.setup()
 
 # Initialize the pretraining model
@@ -1172,7 +1563,9 @@ pretrain_model = pretrain_model(
     d_time_series_num=dm.d_time_series_num(),
     d_target=dm.d_target(),
     pos_frac=dm.pos_frac(),
-    seed=seed
+    seed=seed,
+    compile_forward=compile_forward,
+    warmup_steps=2000
 )
 
 # Initialize the checkpoint callback for saving the best model during pretraining
@@ -1184,24 +1577,35 @@ checkpoint = pl.callbacks.ModelCheckpoint(
     dirpath='checkpoints'
 )
 
-# Initialize the warmup callback for learning rate scheduling
-warmup = WarmUpCallback(steps=2000)
+# Stop pretraining early once the validation loss stops improving, with max_epochs as the upper bound
+early_stopping = pl.callbacks.EarlyStopping(monitor='val_loss', patience=5, min_delta=1e-4, mode='min')
 
-# Initialize the trainer and start pretraining
+# Initialize the trainer and start pretraining, running the transformers under mixed precision on a GPU
 trainer = pl.Trainer(
     logger=False,
     num_sanity_val_steps=2,
     max_epochs=50,
-    gradient_clip_val=1.0,
-    callbacks=[warmup, checkpoint],
-    accelerator='cpu'
+    benchmark=True,
+    callbacks=[AdaptiveClipCallback(max_norm=1.0), checkpoint, early_stopping],
+    accelerator=accelerator,
+    devices=1,
+    precision=precision,
+    plugins=[AsyncCheckpointIO()]
 )
 trainer.fit(pretrain_model, dm)
 
-# Get the path of the pretrained model
+# Get the path of the pretrained model, once every checkpoint has been written
+trainer.strategy.barrier()
 pretrained_path = checkpoint.best_model_path
 
-trainer.test(final_model, dataloaders=dm)
+# Only the path of the best checkpoint is needed from here on, so free the pretraining model, its optimizer state and
+# its trainer before fine-tuning; the data module keeps a reference to the trainer it was last fitted with, which keeps
+# the model alive, so that reference is dropped too
+del pretrain_model, trainer, checkpoint, early_stopping
+dm.trainer = None
+gc.collect()
+if torch.cuda.is_available():
+    torch.cuda.empty_cache()
 
 
 # #### Fine-Tune Model
@@ -1210,52 +1614,95 @@ trainer.test(final_model, dataloaders=dm)
 # In[68]:
 
 
-# Fine-tune the model for different seeds
-final_model = None
-for seed in range(2020, 2023):
-    pl.seed_everything(seed)
+def make_fine_tune_trainer(callbacks):
+    """
+    This function initializes a trainer for fine-tuning a single seed.
+
+    Args:
+        callbacks (list): The clipping, checkpoint and early stopping callbacks of the run.
+
+    Returns:
+        Trainer: The fine-tuning trainer.
+    """
+    return pl.Trainer(
+        logger=False,
+        num_sanity_val_steps=0,
+        max_epochs=20,
+        benchmark=True,
+        callbacks=callbacks,
+        accelerator=accelerator,
+        devices=1,
+        precision=precision,
+        plugins=[AsyncCheckpointIO(SafetensorsCheckpointIO())]
+    )
+
+
+def run_seed(seed):
+    """
+    This function fine-tunes the pretrained model with the given seed, and averages the best models of the run.
+
+    Args:
+        seed (int): The seed for the run.
+
+    Returns:
+        tuple: The trainer of the run, and the model with the averaged weights of the best models of the run.
+    """
+    # Only torch's generators drive the initialization and the shuffling; the model draws its own masks from the seed
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
     fine_tuned_model = fine_tune_model(
         pretrained_path,
         d_static_num=dm.d_static_num(),
         d_time_series_num=dm.d_time_series_num(),
         d_target=dm.d_target(),
         pos_frac=dm.pos_frac(),
-        seed=seed
+        seed=seed,
+        compile_forward=compile_forward,
+        use_grad_ckpt=True,
+        warmup_steps=1000
     )
 
-    # Initialize the checkpoint callback for saving the best models during fine-tuning
-    checkpoint = pl.callbacks.ModelCheckpoint(
-        save_top_k=5,
+    # Initialize the checkpoint callback for saving the weights of the best models during fine-tuning, in a directory
+    # per seed; the optimizer state is not needed, as the checkpoints are only averaged
+    checkpoint = SafetensorsCheckpoint(
+        save_top_k=3,
+        save_weights_only=True,
         save_last=False,
         mode='max',
         monitor='val_ap',
-        dirpath='checkpoints'
+        dirpath=f'checkpoints/seed_{seed}'
     )
 
-    # Initialize the warmup callback for learning rate scheduling
-    warmup = WarmUpCallback(steps=1000)
+    # Stop fine-tuning early once the validation AP stops improving
+    early_stopping = pl.callbacks.EarlyStopping(monitor='val_ap', patience=4, mode='max')
 
-    # Initialize the trainer and start fine-tuning
-    trainer = pl.Trainer(
-        logger=False,
-        max_epochs=20,
-        gradient_clip_val=1.0,
-        callbacks=[warmup, checkpoint],
-        accelerator='cpu'
-    )
+    # Start fine-tuning with a fresh trainer, whose progress and callbacks only belong to this run; cudnn's autotuning
+    # results are kept by the process, so they carry over from the previous seeds
+    trainer = make_fine_tune_trainer([AdaptiveClipCallback(max_norm=1.0), checkpoint, early_stopping])
     trainer.fit(fine_tuned_model, dm)
+    trainer.strategy.barrier()
+
+    # The asynchronous checkpoint I/O is torn down at the end of the fit, once every pending safetensors file is written,
+    # so the weights of the best models can be averaged into the model that was just trained, instead of building another
+    return trainer, streaming_average(checkpoint.best_k_models, fine_tuned_model)
 
-    # Average the weights of the best models and test the final model
-    final_model = average_models([
-        fine_tune_model(
-            path,
-            d_static_num=dm.d_static_num(),
-            d_time_series_num=dm.d_time_series_num(),
-            d_target=dm.d_target(),
-            pos_frac=dm.pos_frac()
-        ) for path in checkpoint.best_k_models.keys()
-    ])
-    trainer.test(final_model, dataloaders=dm)
+
+# Gradient checkpointing of the transformer layers frees enough activation memory to fine-tune with larger batches
+dm.set_batch_size(dm.batch_size * 2)
+
+# Fine-tune the model for different seeds
+for seed in range(2020, 2023):
+    # Only the model of the last seed is kept as the final model, so release the previous one before fine-tuning the next
+    trainer, final_model = None, None
+    dm.trainer = None
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    trainer, final_model = run_seed(seed)
+
+# On CPU, quantize the linear layers of the final model to int8 for testing, as the test pass is pure inference
+if accelerator == 'cpu' and not args.no_quant:
+    final_model = torch.ao.quantization.quantize_dynamic(final_model, {nn.Linear}, dtype=torch.qint8)
 
 # Test the final model
 trainer.test(final_model, dataloaders=dm)
@@ -1270,7 +1717,7 @@ trainer.test(final_model, dataloaders=dm)
 
 # #### Evaluate Base Model
 # 
-# At this point, we have the base iteration of our model, which will be fine-tuned as per the DuETT implementation. These are the metrics returned. 
+# At this point, we have the base iteration of our model, which will be fine-tuned as per the DuETT implementation. The code above no longer tests this model; these are the metrics it returned when it was tested in an earlier run of this notebook.
 # 
 # | Loss Score         | AUROC Score        | Average Precision  |
 # | ------------------ | ------------------ | ------------------ |
@@ -1283,7 +1730,7 @@ trainer.test(final_model, dataloaders=dm)
 
 # #### Evaluate Final Model
 # 
-# At this point, we have the final iteration of the model, post fine-tuning. As seen in the code above, the fine-tuning is performed across multiple `seed` values, and it returns the following scores:
+# At this point, we have the final iteration of the model, post fine-tuning. As seen in the code above, the fine-tuning is performed across multiple `seed` values, but only the final model (the averaged model of the last seed, 2022) is tested. The scores of every seed below were recorded in an earlier run of this notebook, which tested the model of each seed:
 # 
 # | Seed | Loss Score         | AUROC Score        | Average Precision   |
 # | ---- | ------------------ | ------------------ | ------------------- |
@@ -1295,6 +1742,8 @@ trainer.test(final_model, dataloaders=dm)
 # 1. **Loss Score**: Our model's lowest test loss is `0.5696057305793529`.
 # 2. **AUROC Score**: Our model's test AUROC is `0.8056058883666992`.
 # 3. **Average Precision**: Our model's test AP is `0.44990038871765137`.
+# 
+# These scores were recorded with the original fine-tuning pipeline. The fine-tuning has since been changed to run faster: it uses twice the batch size, a per-step learning rate schedule and gradient clipping that switches itself off, averages the top 3 checkpoints of each seed instead of the top 5, and stops early once the validation AP stalls. The current script therefore does not reproduce these scores exactly. In addition, on the CPU the final model is tested with its linear layers quantized to int8 by default, which slightly changes its scores; running the script with the `--no-quant` flag removes that drift, but not the differences that come from the changed fine-tuning.
 
 # #### Comparisons
 # If we compare the 3 key metrics: